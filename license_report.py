@@ -1,10 +1,28 @@
 import os
+import sys
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+from collections import defaultdict
 from msal import ConfidentialClientApplication
 from dotenv import load_dotenv
 from datetime import datetime
+from io import BytesIO, TextIOWrapper
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
+
+# orjson parses large Graph responses faster; fall back to the standard library if it is missing
+try:
+    import orjson as jsonlib
+except ImportError:
+    import json as jsonlib
 
 # Load environment variables
 load_dotenv()
@@ -16,6 +34,44 @@ TENANT_ID = os.getenv('TENANT_ID')
 AUTHORITY = f'https://login.microsoftonline.com/{TENANT_ID}'
 SCOPE = ['https://graph.microsoft.com/.default']
 
+# Shared session so every Graph call reuses the same pooled connection
+session = requests.Session()
+session.headers.update({'Accept': 'application/json'})
+
+# Back off and retry when Graph throttles (429) or is briefly unavailable (503)
+RETRY_STATUSES = [429, 503]
+MAX_RETRIES = 5
+retry = Retry(total=MAX_RETRIES, backoff_factor=0.3, status_forcelist=RETRY_STATUSES, allowed_methods=['GET', 'POST'])
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry))
+
+# Maximum number of requests Graph accepts in a single $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Users holding a given SKU, selecting only the field the report uses
+ASSIGNED_USERS_URL = '/users?$filter=assignedLicenses/any(x:x/skuId eq {sku_id})&$select=displayName&$top=999'
+
+# Excel styles, shared by every cell that uses them
+HEADER_FILL = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+HEADER_FONT = Font(color="FFFFFF", bold=True)
+HEADER_ALIGNMENT = Alignment(horizontal='center')
+FILL_RED = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
+FILL_YELLOW = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
+FILL_GREEN = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
+
+# (header, column width) for each sheet of the report
+SUMMARY_COLUMNS = (
+    ('License Type', 30),
+    ('SKU Code', 20),
+    ('Total Purchased', 15),
+    ('Assigned', 15),
+    ('Available', 15),
+    ('Utilization %', 15),
+)
+ASSIGNMENT_COLUMNS = (
+    ('License Type', 30),
+    ('User Name', 40),
+)
+
 def get_access_token():
     """Authenticate and get access token"""
     print("Authenticating...")
@@ -28,9 +84,10 @@ def get_access_token():
     
     result = app.acquire_token_for_client(scopes=SCOPE)
     
-    if 'access_token' in result:
+    token = result.get('access_token')
+    if token:
         print("✓ Authentication successful\n")
-        return result['access_token']
+        return token
     else:
         print(f"✗ Authentication failed: {result.get('error_description')}\n")
         return None
@@ -47,201 +104,282 @@ def get_subscribed_skus(token):
     url = 'https://graph.microsoft.com/v1.0/subscribedSkus'
     
     try:
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
-        skus = response.json()['value']
+        skus = jsonlib.loads(response.content)['value']
         print(f"✓ Retrieved {len(skus)} license types\n")
         return skus
     except requests.exceptions.RequestException as e:
         print(f"✗ Error retrieving licenses: {e}\n")
         return []
 
-def get_users_with_licenses(token):
-    """Get all users and their assigned licenses"""
-    print("Retrieving users and their licenses...")
+def get_retry_delay(result, attempts):
+    """Seconds to wait before resending a throttled batch sub-request"""
+    retry_after = CaseInsensitiveDict(result.get('headers') or {}).get('Retry-After')
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        # Missing or not a number of seconds, so fall back to exponential backoff
+        return 2 ** attempts
+
+def get_license_assignments(token, skus):
+    """Get the users assigned to each license SKU"""
+    print("Retrieving license assignments...")
     
     headers = {
         'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json'
     }
     
-    # Select only fields we need to reduce data transfer
-    url = 'https://graph.microsoft.com/v1.0/users?$select=displayName,userPrincipalName,assignedLicenses'
+    url = 'https://graph.microsoft.com/v1.0/$batch'
+    users_by_sku = defaultdict(list)
+    
+    # SKUs with no consumed units have no users to look up
+    assigned_skus = [sku for sku in skus if sku['consumedUnits'] > 0]
     
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        users = response.json()['value']
-        print(f"✓ Retrieved {len(users)} users\n")
-        return users
+        # Ask Graph only for the users holding each SKU, up to 20 SKUs per batch request
+        for start in range(0, len(assigned_skus), GRAPH_BATCH_LIMIT):
+            pending = assigned_skus[start:start + GRAPH_BATCH_LIMIT]
+            attempts = 0
+            
+            while pending:
+                batch = {'requests': [
+                    {
+                        'id': str(i),
+                        'method': 'GET',
+                        'url': ASSIGNED_USERS_URL.format(sku_id=sku['skuId'])
+                    }
+                    for i, sku in enumerate(pending)
+                ]}
+                
+                response = session.post(url, headers=headers, json=batch)
+                response.raise_for_status()
+                
+                # Graph reports throttling per sub-request, so collect those to resend in a new batch
+                throttled = []
+                delay = 0
+                for result in jsonlib.loads(response.content)['responses']:
+                    sku = pending[int(result['id'])]
+                    sku_id = sku['skuId']
+                    if result['status'] in RETRY_STATUSES and attempts < MAX_RETRIES:
+                        delay = max(delay, get_retry_delay(result, attempts))
+                        throttled.append(sku)
+                        continue
+                    if result['status'] != 200:
+                        raise requests.exceptions.HTTPError(f"{result['status']} error for license {sku_id}")
+                    
+                    # Follow nextLink for SKUs assigned to more users than fit in one page
+                    data = result['body']
+                    users_by_sku[sku_id].extend(user['displayName'] for user in data['value'])
+                    next_url = data.get('@odata.nextLink')
+                    while next_url:
+                        page = session.get(next_url, headers=headers)
+                        page.raise_for_status()
+                        data = jsonlib.loads(page.content)
+                        users_by_sku[sku_id].extend(user['displayName'] for user in data['value'])
+                        next_url = data.get('@odata.nextLink')
+                
+                if throttled:
+                    time.sleep(delay)
+                    attempts += 1
+                pending = throttled
+        
+        total = sum(len(names) for names in users_by_sku.values())
+        print(f"✓ Retrieved {total} license assignments\n")
+        return users_by_sku
     except requests.exceptions.RequestException as e:
-        print(f"✗ Error retrieving users: {e}\n")
-        return []
+        print(f"✗ Error retrieving license assignments: {e}\n")
+        return None
 
-def get_friendly_license_name(sku_part_number):
-    """Convert SKU codes to friendly names"""
-    # Common Microsoft license names
-    license_names = {
-        'ENTERPRISEPACK': 'Office 365 E3',
-        'ENTERPRISEPREMIUM': 'Office 365 E5',
-        'SPE_E3': 'Microsoft 365 E3',
-        'SPE_E5': 'Microsoft 365 E5',
-        'STANDARDPACK': 'Office 365 E1',
-        'DESKLESSPACK': 'Office 365 F3',
-        'EXCHANGESTANDARD': 'Exchange Online (Plan 1)',
-        'EXCHANGEENTERPRISE': 'Exchange Online (Plan 2)',
-        'SHAREPOINTSTANDARD': 'SharePoint Online (Plan 1)',
-        'SHAREPOINTENTERPRISE': 'SharePoint Online (Plan 2)',
-        'POWER_BI_STANDARD': 'Power BI (Free)',
-        'POWER_BI_PRO': 'Power BI Pro',
-        'PROJECTPROFESSIONAL': 'Project Plan 3',
-        'VISIOCLIENT': 'Visio Plan 2',
-        'TEAMS_EXPLORATORY': 'Microsoft Teams Exploratory',
-        'FLOW_FREE': 'Power Automate Free',
-        'POWERAPPS_VIRAL': 'Power Apps Trial',
-    }
-    
-    return license_names.get(sku_part_number, sku_part_number)
+# Friendly names for common Microsoft license SKUs (unknown SKUs keep their code)
+LICENSE_NAMES = {
+    'ENTERPRISEPACK': 'Office 365 E3',
+    'ENTERPRISEPREMIUM': 'Office 365 E5',
+    'SPE_E3': 'Microsoft 365 E3',
+    'SPE_E5': 'Microsoft 365 E5',
+    'STANDARDPACK': 'Office 365 E1',
+    'DESKLESSPACK': 'Office 365 F3',
+    'EXCHANGESTANDARD': 'Exchange Online (Plan 1)',
+    'EXCHANGEENTERPRISE': 'Exchange Online (Plan 2)',
+    'SHAREPOINTSTANDARD': 'SharePoint Online (Plan 1)',
+    'SHAREPOINTENTERPRISE': 'SharePoint Online (Plan 2)',
+    'POWER_BI_STANDARD': 'Power BI (Free)',
+    'POWER_BI_PRO': 'Power BI Pro',
+    'PROJECTPROFESSIONAL': 'Project Plan 3',
+    'VISIOCLIENT': 'Visio Plan 2',
+    'TEAMS_EXPLORATORY': 'Microsoft Teams Exploratory',
+    'FLOW_FREE': 'Power Automate Free',
+    'POWERAPPS_VIRAL': 'Power Apps Trial',
+}
 
-def analyze_licenses(skus, users):
+def analyze_licenses(skus):
     """Analyze license usage"""
     print("Analyzing license usage...")
     
     license_data = []
     
+    # Bind lookups used on every iteration to locals
+    get_name = LICENSE_NAMES.get
+    add_license = license_data.append
+    
     for sku in skus:
-        sku_id = sku['skuId']
-        sku_part_number = sku['skuPartNumber']
-        friendly_name = get_friendly_license_name(sku_part_number)
+        sku_part_number, prepaid, consumed = sku['skuPartNumber'], sku['prepaidUnits'], sku['consumedUnits']
+        friendly_name = get_name(sku_part_number, sku_part_number)
         
         # Get totals
-        enabled = sku['prepaidUnits']['enabled']
-        consumed = sku['consumedUnits']
+        enabled = prepaid['enabled']
         available = enabled - consumed
         
-        # Find users with this license
-        users_with_license = []
-        for user in users:
-            if any(license['skuId'] == sku_id for license in user.get('assignedLicenses', [])):
-                users_with_license.append(user['displayName'])
-        
-        license_data.append({
+        add_license({
             'license_name': friendly_name,
             'sku_code': sku_part_number,
             'total_licenses': enabled,
             'assigned': consumed,
             'available': available,
-            'utilization_pct': (consumed / enabled * 100) if enabled > 0 else 0,
-            'users': users_with_license
+            'utilization_pct': (consumed / enabled * 100) if enabled > 0 else 0
         })
     
     print(f"✓ Analysis complete\n")
     return license_data
 
-def create_excel_report(license_data):
+def iter_user_assignments(skus, license_data, users_by_sku):
+    """Yield (license name, user name) pairs for every license assignment"""
+    # license_data has one entry per SKU, in the same order, so reuse its resolved names
+    for sku, lic in zip(skus, license_data):
+        for user in users_by_sku.get(sku['skuId'], []):
+            yield lic['license_name'], user
+
+def save_with_user_assignments(workbook_file, filename, sheet_path, user_assignments):
+    """Copy the workbook to filename, writing the user assignment rows straight into the sheet XML"""
+    # Build the report under a temporary name so a failure never leaves a truncated file behind
+    tmp_filename = f'{filename}.tmp'
+    try:
+        with ZipFile(workbook_file) as src, ZipFile(tmp_filename, 'w', ZIP_DEFLATED) as dst:
+            for item in src.infolist():
+                if item.filename != sheet_path:
+                    dst.writestr(item, src.read(item.filename))
+                    continue
+                
+                # Keep the header row and column widths openpyxl wrote, and append the data rows after them
+                head, tail = src.read(sheet_path).decode('utf-8').split('</sheetData>')
+                with TextIOWrapper(dst.open(sheet_path, 'w'), encoding='utf-8') as out:
+                    out.write(head)
+                    for row, (license_name, user) in enumerate(user_assignments, start=2):
+                        # Graph may return a null displayName; drop control characters XML forbids
+                        license_name = ILLEGAL_CHARACTERS_RE.sub('', license_name or '')
+                        user = ILLEGAL_CHARACTERS_RE.sub('', user or '')
+                        out.write(
+                            f'<row r="{row}">'
+                            f'<c r="A{row}" t="inlineStr"><is><t xml:space="preserve">{escape(license_name)}</t></is></c>'
+                            f'<c r="B{row}" t="inlineStr"><is><t xml:space="preserve">{escape(user)}</t></is></c>'
+                            '</row>'
+                        )
+                    out.write('</sheetData>' + tail)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def create_excel_report(license_data, user_assignments):
     """Create formatted Excel report"""
     print("Creating Excel report...")
     
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "License Summary"
+    # Write-only mode streams rows to disk instead of keeping every cell in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("License Summary")
     
-    # Header styling
-    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    header_font = Font(color="FFFFFF", bold=True)
+    # Adjust column widths (must be set before any rows are appended)
+    for col, (_, width) in enumerate(SUMMARY_COLUMNS, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
     
     # Headers
-    headers = ['License Type', 'SKU Code', 'Total Purchased', 'Assigned', 'Available', 'Utilization %']
-    ws.append(headers)
-    
-    for cell in ws[1]:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center')
-    
-    # Data rows
+    header_cells = [WriteOnlyCell(ws, value=header) for header, _ in SUMMARY_COLUMNS]
+    for cell in header_cells:
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+        cell.alignment = HEADER_ALIGNMENT
+    ws.append(header_cells)
+    
+    # Data rows, with utilization color coded as each row is written
     for lic in license_data:
+        util_value = lic['utilization_pct']
+        
+        util_cell = WriteOnlyCell(ws, value=f"{util_value:.1f}%")
+        util_cell.fill = FILL_RED if util_value < 50 else FILL_YELLOW if util_value < 80 else FILL_GREEN
+        
         ws.append([
             lic['license_name'],
             lic['sku_code'],
             lic['total_licenses'],
             lic['assigned'],
             lic['available'],
-            f"{lic['utilization_pct']:.1f}%"
+            util_cell
         ])
     
-    # Color code utilization
-    for row in range(2, len(license_data) + 2):
-        util_cell = ws.cell(row=row, column=6)
-        util_value = license_data[row-2]['utilization_pct']
-        
-        if util_value < 50:
-            util_cell.fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")  # Red
-        elif util_value < 80:
-            util_cell.fill = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")  # Yellow
-        else:
-            util_cell.fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")  # Green
-    
-    # Adjust column widths
-    ws.column_dimensions['A'].width = 30
-    ws.column_dimensions['B'].width = 20
-    ws.column_dimensions['C'].width = 15
-    ws.column_dimensions['D'].width = 15
-    ws.column_dimensions['E'].width = 15
-    ws.column_dimensions['F'].width = 15
-    
     # Create detailed sheet with user assignments
     ws2 = wb.create_sheet("User Assignments")
-    ws2.append(['License Type', 'User Name'])
-    ws2[1][0].fill = header_fill
-    ws2[1][0].font = header_font
-    ws2[1][1].fill = header_fill
-    ws2[1][1].font = header_font
+    for col, (_, width) in enumerate(ASSIGNMENT_COLUMNS, start=1):
+        ws2.column_dimensions[get_column_letter(col)].width = width
     
-    for lic in license_data:
-        for user in lic['users']:
-            ws2.append([lic['license_name'], user])
+    header_cells = [WriteOnlyCell(ws2, value=header) for header, _ in ASSIGNMENT_COLUMNS]
+    for cell in header_cells:
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+    ws2.append(header_cells)
     
-    ws2.column_dimensions['A'].width = 30
-    ws2.column_dimensions['B'].width = 40
+    # The user rows are plain strings, so they skip openpyxl and are written as XML while saving
+    sheet_path = f'xl/worksheets/sheet{wb.index(ws2) + 1}.xml'
     
     # Save file
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     filename = f'license_report_{timestamp}.xlsx'
-    wb.save(filename)
+    workbook_file = BytesIO()
+    wb.save(workbook_file)
+    save_with_user_assignments(workbook_file, filename, sheet_path, user_assignments)
     
     print(f"✓ Report saved to: {filename}\n")
     return filename
 
 def print_summary(license_data):
     """Print summary to console"""
-    print("=" * 70)
-    print("LICENSE USAGE SUMMARY")
-    print("=" * 70)
-    
-    total_licenses = sum(lic['total_licenses'] for lic in license_data)
-    total_assigned = sum(lic['assigned'] for lic in license_data)
-    total_available = sum(lic['available'] for lic in license_data)
-    
-    print(f"Total Licenses Purchased:  {total_licenses}")
-    print(f"Total Assigned:            {total_assigned}")
-    print(f"Total Available (Unused):  {total_available}")
-    print(f"Overall Utilization:       {(total_assigned/total_licenses*100):.1f}%")
-    print()
-    
-    # Show licenses with low utilization (potential waste)
-    print("⚠️  LOW UTILIZATION LICENSES (Potential Cost Savings):")
-    print("-" * 70)
-    
-    low_util = [lic for lic in license_data if lic['utilization_pct'] < 70 and lic['total_licenses'] > 0]
+    # Accumulate totals and collect low utilization licenses in a single pass
+    total_licenses = total_assigned = total_available = 0
+    low_util = []
+    for lic in license_data:
+        total_licenses += lic['total_licenses']
+        total_assigned += lic['assigned']
+        total_available += lic['available']
+        if lic['utilization_pct'] < 70 and lic['total_licenses'] > 0:
+            low_util.append(lic)
+    
+    overall_pct = (total_assigned / total_licenses * 100) if total_licenses > 0 else 0
+    
+    lines = [
+        "=" * 70,
+        "LICENSE USAGE SUMMARY",
+        "=" * 70,
+        f"Total Licenses Purchased:  {total_licenses}",
+        f"Total Assigned:            {total_assigned}",
+        f"Total Available (Unused):  {total_available}",
+        f"Overall Utilization:       {overall_pct:.1f}%",
+        "",
+        # Show licenses with low utilization (potential waste)
+        "⚠️  LOW UTILIZATION LICENSES (Potential Cost Savings):",
+        "-" * 70,
+    ]
     
     if low_util:
         for lic in sorted(low_util, key=lambda x: x['available'], reverse=True):
-            print(f"{lic['license_name']:40} | {lic['available']:3} unused ({lic['utilization_pct']:.0f}% utilization)")
+            lines.append(f"{lic['license_name']:40} | {lic['available']:3} unused ({lic['utilization_pct']:.0f}% utilization)")
     else:
-        print("No licenses with low utilization found.")
+        lines.append("No licenses with low utilization found.")
+    
+    lines.append("=" * 70)
     
-    print("=" * 70)
+    # Write the whole summary at once rather than line by line
+    sys.stdout.write("\n".join(lines) + "\n")
 
 def main():
     print("\n" + "=" * 70)
@@ -260,17 +398,17 @@ def main():
         print("No licenses found or error retrieving licenses.")
         return
     
-    # Step 3: Get users and their license assignments
-    users = get_users_with_licenses(token)
-    if not users:
-        print("No users found or error retrieving users.")
+    # Step 3: Get the users assigned to each license
+    users_by_sku = get_license_assignments(token, skus)
+    if users_by_sku is None:
+        print("Error retrieving license assignments.")
         return
     
     # Step 4: Analyze license usage
-    license_data = analyze_licenses(skus, users)
+    license_data = analyze_licenses(skus)
     
     # Step 5: Create Excel report
-    create_excel_report(license_data)
+    create_excel_report(license_data, iter_user_assignments(skus, license_data, users_by_sku))
     
     # Step 6: Print summary
     print_summary(license_data)